@@ -3,73 +3,429 @@ import re
 import hmac
 import hashlib
 import base64
+import sys
+import atexit
+import logging
+import logging.handlers
+import time
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, request, jsonify, abort
+from urllib.parse import urlparse, parse_qs
+import orjson
+from flask import Flask, Response, request, jsonify, abort
+from flask.json.provider import DefaultJSONProvider
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+from slack_sdk.signature import SignatureVerifier
 from dotenv import load_dotenv
 
 # ---------------- INIT ----------------
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 load_dotenv()
+
+# Request threads only enqueue log records; a listener thread does the formatting and I/O
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger("shopify_bridge")
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Comment webhooks are a few KB; reject oversized bodies before hashing or parsing them
+app.config["MAX_CONTENT_LENGTH"] = 512 * 1024
 
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 SLACK_CHANNEL_ID = os.getenv("SLACK_CHANNEL_ID")
+SLACK_USER_TOKEN = os.getenv("SLACK_USER_TOKEN")
+SLACK_SIGNING_SECRET = os.getenv("SLACK_SIGNING_SECRET")
 SHOPIFY_WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET")
 
+# Encoded once so each webhook goes straight to the OpenSSL HMAC
+SECRET_BYTES = SHOPIFY_WEBHOOK_SECRET.encode("utf-8") if SHOPIFY_WEBHOOK_SECRET else None
+
+# Keyed once at startup; copying it per request skips the ipad/opad key blocks
+_PREPPED_HMAC = hmac.new(SECRET_BYTES, digestmod="sha256") if SECRET_BYTES else None
+
 slack = WebClient(token=SLACK_BOT_TOKEN)
+# Honour Retry-After on 429s inside the SDK (keeps the default connection-error handler)
+slack.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=3))
+
+# search.messages only accepts user tokens (search:read); without one we scan history
+slack_search = WebClient(token=SLACK_USER_TOKEN) if SLACK_USER_TOKEN else None
+if slack_search:
+    slack_search.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=3))
+
+# Slack Events API pushes new channel messages to /slack/events; only enabled with a signing secret
+slack_verifier = SignatureVerifier(SLACK_SIGNING_SECRET) if SLACK_SIGNING_SECRET else None
 
 # STRICT MATCH: ONLY "ST.order #1234"
-ORDER_REGEX = re.compile(r"\bST\.order\s+#(\d+)\b", re.IGNORECASE)
+# At most 18 digits, so int() on the capture can never hit the 4300-digit conversion limit
+ORDER_REGEX = re.compile(r"\bST\.order\s+#(\d{1,18})\b", re.IGNORECASE | re.ASCII)
+
+
+# ---------------- CACHE ----------------
+class BoundedCache:
+    """Thread-safe, size-capped mapping whose entries expire `ttl` seconds after they were stored."""
+
+    _MISSING = object()
+
+    def __init__(self, max_size=10_000, ttl=7200):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, stored_at), oldest first
+        self._lock = threading.Lock()
+
+    def _get(self, key, default):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, stored_at = item
+        if time.monotonic() - stored_at > self.ttl:
+            self._data.pop(key, None)
+            return default
+        return value
+
+    def _set(self, key, value):
+        now = time.monotonic()
+        self._data[key] = (value, now)
+        self._data.move_to_end(key)
+
+        # Entries are kept in store order, so expired ones are always at the front
+        while self._data:
+            _, stored_at = next(iter(self._data.values()))
+            if now - stored_at <= self.ttl and len(self._data) <= self.max_size:
+                break
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def add(self, key):
+        self.set(key, True)
+
+    def add_if_absent(self, key):
+        # Check-and-set under one lock, so concurrent callers can't both claim the same key
+        with self._lock:
+            if self._get(key, self._MISSING) is not self._MISSING:
+                return False
+            self._set(key, True)
+            return True
+
+    def set_if(self, key, value, replace):
+        # Stores value if key is absent, or if replace(current) is true; atomic like add_if_absent
+        with self._lock:
+            current = self._get(key, self._MISSING)
+            if current is not self._MISSING and not replace(current):
+                return False
+            self._set(key, value)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_values(self, values):
+        # Drops every key mapped to one of values; a linear scan, only used on edits/deletions
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if v in values]:
+                del self._data[key]
+
+    def __contains__(self, key):
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def __len__(self):
+        return len(self._data)
+
 
 # Prevent duplicate Slack replies
-processed = set()
+processed = BoundedCache(max_size=10_000, ttl=2 * 60 * 60)
+
+# Shopify X-Shopify-Webhook-Id values already accepted; retries skip HMAC entirely
+seen_deliveries = BoundedCache(max_size=10_000, ttl=24 * 60 * 60)
 
-print("🚀 Shopify GraphQL → Slack bridge started", flush=True)
+# Order number (int) -> Slack thread ts, filled on demand so repeat comments skip the history scan
+order_threads = BoundedCache(max_size=10_000, ttl=24 * 60 * 60)
+
+# Newest HISTORY_LIMIT channel messages (newest first), refreshed at most every HISTORY_TTL
+# seconds by fetching only what was posted after the newest one we already hold.
+# TTL kept short because an order message posted inside the window is invisible until then.
+# Every HISTORY_FULL_REFRESH seconds the whole page is re-read instead, so edits and
+# deletions of messages already in the window are picked up even without /slack/events.
+HISTORY_LIMIT = 200
+HISTORY_TTL = 10
+HISTORY_FULL_REFRESH = 300
+history = {"messages": [], "checked_at": float("-inf"), "full_at": float("-inf")}
+history_lock = threading.Lock()
+
+logger.info("🚀 Shopify GraphQL → Slack bridge started")
 
 # ---------------- VERIFY WEBHOOK ----------------
+_B64DECODE = base64.b64decode
+
+
 def verify_shopify(raw_body, hmac_header):
-    if not SHOPIFY_WEBHOOK_SECRET:
-        print("⚠️ No webhook secret set — skipping verification")
+    if not SECRET_BYTES:
+        logger.warning("⚠️ No webhook secret set — skipping verification")
         return True
 
     if not hmac_header:
-        print("❌ Missing X-Shopify-Hmac-Sha256 header")
+        logger.error("❌ Missing X-Shopify-Hmac-Sha256 header")
+        return False
+
+    # A base64 SHA-256 digest is always 44 chars ending in "=", so reject anything else unread
+    if len(hmac_header) != 44 or hmac_header[-1] != "=":
+        logger.error("❌ Malformed X-Shopify-Hmac-Sha256 header")
         return False
 
     try:
-        calculated = hmac.new(
-            SHOPIFY_WEBHOOK_SECRET.encode("utf-8"),
-            raw_body,
-            hashlib.sha256
-        ).digest()
+        received = _B64DECODE(hmac_header, validate=True)
+    except ValueError as e:
+        logger.error("❌ HMAC verification error: %s", e)
+        return False
 
-        received = base64.b64decode(hmac_header)
-        return hmac.compare_digest(calculated, received)
+    h = _PREPPED_HMAC.copy()
+    h.update(raw_body)
+    return hmac.compare_digest(h.digest(), received)
 
-    except Exception as e:
-        print("❌ HMAC verification error:", e, flush=True)
+
+# ---------------- SLACK ----------------
+# All posts go through one background worker so webhooks never wait on Slack
+# and the channel stays under Slack's ~1 message/second posting limit
+SLACK_POST_RATE = 1.0      # sustained messages per second
+SLACK_POST_BURST = 3       # messages allowed back-to-back after a quiet spell
+COALESCE_WINDOW = 1.0      # seconds; same-thread replies this close become one post
+COALESCE_DEBOUNCE = 0.5    # seconds a thread reply is held for follow-ups before posting
+MAX_BLOCKS = 50            # Slack's per-message block limit
+
+slack_queue = queue.Queue(maxsize=1024)
+
+
+def enqueue_post(**kwargs):
+    try:
+        slack_queue.put_nowait((time.monotonic(), kwargs))
+        return True
+    except queue.Full:
+        logger.error("❌ Slack post queue full — message dropped")
         return False
 
 
-# ---------------- SLACK ----------------
-def find_thread(order_number):
-    search = f"st.order #{order_number}"
+def _can_coalesce(first, first_at, nxt, nxt_at):
+    return (
+        first.get("thread_ts")
+        and first.get("thread_ts") == nxt.get("thread_ts")
+        and first.get("channel") == nxt.get("channel")
+        and nxt_at - first_at <= COALESCE_WINDOW
+        and len(first.get("blocks", [])) + len(nxt.get("blocks", [])) <= MAX_BLOCKS
+    )
+
+
+def _merge_posts(first, nxt):
+    merged = dict(first)
+    merged["text"] = f"{first['text']}\n{nxt['text']}"
+    if first.get("blocks") or nxt.get("blocks"):
+        merged["blocks"] = first.get("blocks", []) + nxt.get("blocks", [])
+    return merged
+
+
+def slack_poster():
+    backlog = deque()  # job pulled while coalescing that belongs to another thread
+    tokens, last = SLACK_POST_BURST, time.monotonic()
+
+    while True:
+        queued_at, post = backlog.popleft() if backlog else slack_queue.get()
+
+        # ---- Token bucket ----
+        now = time.monotonic()
+        tokens = min(SLACK_POST_BURST, tokens + (now - last) * SLACK_POST_RATE)
+        last = now
+        if tokens < 1:
+            time.sleep((1 - tokens) / SLACK_POST_RATE)
+            tokens, last = 1, time.monotonic()
+        tokens -= 1
+
+        # ---- Coalesce consecutive replies to the same thread ----
+        # A thread reply is held until COALESCE_DEBOUNCE after it was queued, so a burst of
+        # comments on one order goes out as a single chat.postMessage
+        while True:
+            wait = queued_at + COALESCE_DEBOUNCE - time.monotonic() if post.get("thread_ts") else 0
+            try:
+                if backlog:
+                    nxt_at, nxt = backlog.popleft()
+                elif wait > 0:
+                    nxt_at, nxt = slack_queue.get(timeout=wait)
+                else:
+                    nxt_at, nxt = slack_queue.get_nowait()
+            except queue.Empty:
+                break
+            if not _can_coalesce(post, queued_at, nxt, nxt_at):
+                backlog.appendleft((nxt_at, nxt))
+                break
+            post = _merge_posts(post, nxt)
+
+        try:
+            slack.chat_postMessage(**post)
+            logger.info("✅ Slack message posted")
+        except SlackApiError as e:
+            logger.error("❌ Slack post error: %s", e.response["error"])
+        except Exception as e:
+            logger.error("❌ Slack post error: %s", e)
+
+
+threading.Thread(target=slack_poster, name="slack-poster", daemon=True).start()
+
+
+def _is_thread_parent(msg):
+    # Search also returns thread replies (including our own, which repeat the tag);
+    # a reply's permalink carries its parent's ts as thread_ts
+    thread_ts = parse_qs(urlparse(msg.get("permalink", "")).query).get("thread_ts")
+    return not thread_ts or thread_ts[0] == msg.get("ts")
+
+
+def search_thread(order_number):
     try:
-        res = slack.conversations_history(
-            channel=SLACK_CHANNEL_ID,
-            limit=200
+        res = slack_search.search_messages(
+            query=f'"ST.order #{order_number}" in:<#{SLACK_CHANNEL_ID}>',
+            sort="timestamp",
+            count=20
         )
-        for msg in res.get("messages", []):
-            if search in msg.get("text", "").lower():
+        # Slack search is fuzzy, so confirm the exact tag before trusting a hit
+        for msg in res.get("messages", {}).get("matches", []):
+            if not _is_thread_parent(msg):
+                continue
+            match = ORDER_REGEX.search(msg.get("text", ""))
+            if match and int(match.group(1)) == order_number:
                 return msg["ts"]
     except SlackApiError as e:
-        print("❌ Slack search error:", e.response["error"], flush=True)
+        logger.error("❌ Slack search error: %s", e.response["error"])
     return None
 
 
+def fetch_history():
+    if time.monotonic() - history["checked_at"] < HISTORY_TTL:
+        return history["messages"]
+
+    # Single flight: workers that miss together wait for one fetch instead of each calling Slack
+    with history_lock:
+        messages = history["messages"]
+        if time.monotonic() - history["checked_at"] < HISTORY_TTL:
+            return messages
+
+        full = not messages or time.monotonic() - history["full_at"] >= HISTORY_FULL_REFRESH
+        params = {"channel": SLACK_CHANNEL_ID, "limit": HISTORY_LIMIT}
+        if not full:
+            params["oldest"] = messages[0]["ts"]  # exclusive: only messages newer than this
+
+        try:
+            res = slack.conversations_history(**params)
+        except Exception:
+            # Stamp the failure too, so callers queued on the lock reuse the current window
+            # instead of each repeating the failing call; the next refresh is one TTL away
+            history["checked_at"] = time.monotonic()
+            raise
+
+        if full:
+            fresh = res.get("messages", [])
+            forget_stale(messages, fresh)
+            messages = fresh
+            history["full_at"] = time.monotonic()
+        else:
+            messages = (res.get("messages", []) + messages)[:HISTORY_LIMIT]
+
+        history["messages"] = messages
+        history["checked_at"] = time.monotonic()
+        return messages
+
+
+def forget_stale(old, fresh):
+    # A message from the old window that is missing from (or reworded in) a fresh page that
+    # still reaches back to it was deleted (or edited): drop the threads indexed from it
+    floor = float(fresh[-1]["ts"]) if len(fresh) >= HISTORY_LIMIT else float("-inf")
+    texts = {msg["ts"]: msg.get("text", "") for msg in fresh}
+    stale = {
+        msg["ts"] for msg in old
+        if float(msg["ts"]) >= floor and texts.get(msg["ts"]) != msg.get("text", "")
+    }
+    if stale:
+        order_threads.discard_values(stale)
+
+
+def patch_history(ts, message=None):
+    # Mirrors an edit (message) or deletion (None) into the cached window. Not under
+    # history_lock, so an event racing a refresh can be lost until the next full re-read.
+    window = []
+    for msg in history["messages"]:
+        if msg["ts"] != ts:
+            window.append(msg)
+        elif message is not None:
+            window.append(message)
+    history["messages"] = window
+
+
+def scan_history(order_number):
+    found = None
+    try:
+        messages = fetch_history()
+
+        # One pass indexes every order tag on the page (newest message wins), so
+        # misses for other orders in the same window are served from order_threads
+        indexed = set()
+        finditer = ORDER_REGEX.finditer
+        for msg in messages:
+            text = msg.get("text", "")
+            # Every tag contains a literal "#"; skipping messages without one avoids the
+            # regex on most of the page and, unlike "ST.order", needs no case folding
+            if "#" not in text:
+                continue
+            for match in finditer(text):
+                number = int(match.group(1))
+                if number in indexed:
+                    continue
+                indexed.add(number)
+                # The window can be up to HISTORY_TTL stale, so never replace a newer thread
+                # recorded by /slack/events or search_thread
+                ts = msg["ts"]
+                order_threads.set_if(number, ts, lambda current: float(current) < float(ts))
+                if number == order_number:
+                    found = order_threads.get(number, ts)
+    except SlackApiError as e:
+        logger.error("❌ Slack history error: %s", e.response["error"])
+    return found
+
+
+def find_thread(order_number):
+    ts = order_threads.get(order_number)
+    if ts:
+        return ts
+
+    ts = (slack_search and search_thread(order_number)) or scan_history(order_number)
+    if ts:
+        order_threads.set(order_number, ts)
+    return ts
+
+
 def reply_thread(ts, text, author):
-    slack.chat_postMessage(
+    return enqueue_post(
         channel=SLACK_CHANNEL_ID,
         thread_ts=ts,
         text=text,
@@ -86,13 +442,148 @@ def reply_thread(ts, text, author):
                 "elements": [
                     {
                         "type": "mrkdwn",
-                        "text": f"_From Shopify • {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}_"
+                        "text": f"_From Shopify • {datetime.now().isoformat(sep=' ', timespec='seconds')}_"
                     }
                 ]
             }
         ]
     )
-    print("✅ Slack thread reply posted", flush=True)
+
+
+# ---------------- WORKER ----------------
+# Slack lookups run off the request thread so Shopify gets its ACK right after verification
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("WORKERS", 8)),
+    thread_name_prefix="comment"
+)
+
+# The executor's own queue is unbounded; cap accepted-but-unfinished comments so a burst
+# gets 503s (and Shopify retries) instead of an ever-growing backlog
+MAX_PENDING = 256
+pending_slots = threading.BoundedSemaphore(MAX_PENDING)
+
+
+def post_comment(order_number, comment_text, author, ts):
+    if ts:
+        reply_thread(ts, comment_text, author)
+        return
+
+    # ---- Fallback: post as new message ----
+    enqueue_post(
+        channel=SLACK_CHANNEL_ID,
+        text=f"💬 *Comment on ST.order #{order_number}*\n{comment_text}\n_(Thread not found)_"
+    )
+    logger.warning("⚠️ Slack thread not found — posting as new message")
+
+
+def process_comment(order_number, comment_text, author):
+    try:
+        try:
+            ts = find_thread(order_number)
+        except Exception as e:
+            # Shopify already has its 202, so a failed lookup must still get the comment posted
+            logger.exception("❌ Slack thread lookup error: %s", e)
+            post_comment(order_number, comment_text, author, None)
+            return
+
+        # A comment can beat its order message to Slack; with the Events API enabled, hand it to
+        # the thread waiter instead of holding this worker until the message shows up
+        if not ts and slack_verifier and wait_for_thread(order_number, comment_text, author):
+            return
+
+        post_comment(order_number, comment_text, author, ts)
+
+    except Exception as e:
+        logger.exception("❌ Comment processing error: %s", e)
+
+    finally:
+        pending_slots.release()
+
+
+# ---------------- THREAD WAITER ----------------
+# Comments whose order message hasn't reached Slack yet. One waiter thread re-checks all of
+# them, so no pool worker is parked while /slack/events (or a history re-poll) finds the thread
+THREAD_WAIT = 30   # seconds before giving up and posting as a new message
+MAX_WAITING = 256  # beyond this, comments fall back immediately
+
+waiting = []
+waiting_lock = threading.Lock()
+waiting_wakeup = threading.Event()  # set when a comment is parked or /slack/events indexes an order
+
+
+def wait_for_thread(order_number, comment_text, author):
+    now = time.monotonic()
+    with waiting_lock:
+        if len(waiting) >= MAX_WAITING:
+            return False
+        waiting.append({
+            "order_number": order_number,
+            "comment_text": comment_text,
+            "author": author,
+            "deadline": now + THREAD_WAIT,
+            "next_poll": now + 1.0,
+            "delay": 1.0,
+        })
+    waiting_wakeup.set()
+    return True
+
+
+def _check_waiting():
+    now = time.monotonic()
+    with waiting_lock:
+        current = list(waiting)
+
+    # Re-poll only the throttled history scan (never search.messages); it indexes every order
+    # on the page, so one refresh serves all due comments
+    if any(now >= w["next_poll"] and w["order_number"] not in order_threads for w in current):
+        try:
+            scan_history(None)
+        except Exception as e:
+            logger.error("❌ Slack history error: %s", e)
+
+    for w in current:
+        ts = order_threads.get(w["order_number"])
+        if not ts and now < w["deadline"]:
+            if now >= w["next_poll"]:
+                # Backoff between re-polls: 1s, 1.5s, … capped at 10s
+                w["delay"] = min(w["delay"] * 1.5, 10)
+                w["next_poll"] = min(now + w["delay"], w["deadline"])
+            continue
+
+        with waiting_lock:
+            waiting.remove(w)
+        post_comment(w["order_number"], w["comment_text"], w["author"], ts)
+
+
+def thread_waiter():
+    while True:
+        with waiting_lock:
+            next_poll = min((w["next_poll"] for w in waiting), default=None)
+        timeout = None if next_poll is None else max(0, next_poll - time.monotonic())
+
+        waiting_wakeup.wait(timeout)
+        waiting_wakeup.clear()
+
+        try:
+            _check_waiting()
+        except Exception as e:
+            logger.exception("❌ Thread waiter error: %s", e)
+
+
+threading.Thread(target=thread_waiter, name="thread-waiter", daemon=True).start()
+
+
+# ---------------- RESPONSES ----------------
+# Webhook replies are fixed, so serialize them once; status is baked in so Flask never mutates them
+def _status_response(status, code):
+    return Response(orjson.dumps({"status": status}), status=code, mimetype="application/json")
+
+
+RESP_DUPLICATE = _status_response("duplicate", 200)
+RESP_NO_COMMENT = _status_response("no_comment", 200)
+RESP_NO_PATTERN = _status_response("no_pattern", 200)
+RESP_BUSY = _status_response("busy", 503)
+RESP_QUEUED = _status_response("queued", 202)
 
 
 # ---------------- ROUTES ----------------
@@ -103,15 +594,26 @@ def health():
 
 @app.route("/webhook/shopify", methods=["POST"])
 def webhook():
-    print("🔥 GraphQL webhook HIT", flush=True)
+    logger.debug("🔥 GraphQL webhook HIT")
+
+    # Only ids that passed verification are ever stored, so this can't be spoofed into skipping work
+    delivery_id = request.headers.get("X-Shopify-Webhook-Id")
+    if delivery_id and delivery_id in seen_deliveries:
+        logger.info("⏭️ Duplicate delivery ignored")
+        return RESP_DUPLICATE
+
+    raw_body = request.get_data(cache=False)
 
     if not verify_shopify(
-        request.data,
+        raw_body,
         request.headers.get("X-Shopify-Hmac-Sha256")
     ):
         abort(401, "Invalid webhook signature")
 
-    payload = request.get_json(silent=True) or {}
+    try:
+        payload = orjson.loads(raw_body) or {}
+    except orjson.JSONDecodeError:
+        payload = {}
 
     # -------- CORRECT GRAPHQL PAYLOAD --------
     comment_event = payload.get("commentEvent", {})
@@ -119,40 +621,101 @@ def webhook():
     author = comment_event.get("author", {}).get("name", "Shopify")
 
     if not comment_text:
-        print("⏭️ No comment text in payload", flush=True)
-        return {"status": "no_comment"}, 200
+        logger.debug("⏭️ No comment text in payload")
+        return RESP_NO_COMMENT
 
-    match = ORDER_REGEX.search(comment_text)
+    # Most comments never mention an order, so a C-level substring test gates the regex
+    match = "st.order" in comment_text.lower() and ORDER_REGEX.search(comment_text)
     if not match:
-        print("⏭️ Pattern not matched", flush=True)
-        return {"status": "no_pattern"}, 200
+        logger.debug("⏭️ Pattern not matched")
+        return RESP_NO_PATTERN
 
-    order_number = match.group(1)
+    # Int keys hash cheaper than fresh strings and make "#0123" and "#123" the same order
+    order_number = int(match.group(1))
 
     # ---- Deduplication ----
-    fingerprint = f"{order_number}:{comment_text.strip()}"
-    if fingerprint in processed:
-        print("⏭️ Duplicate comment ignored", flush=True)
-        return {"status": "duplicate"}, 200
+    # 8-byte BLAKE2b key: only used for local dedup, so no cryptographic strength needed
+    fingerprint = hashlib.blake2b(
+        f"{order_number}:{comment_text.strip()}".encode("utf-8"),
+        digest_size=8
+    ).digest()
+    if not processed.add_if_absent(fingerprint):
+        logger.info("⏭️ Duplicate comment ignored")
+        return RESP_DUPLICATE
 
-    processed.add(fingerprint)
+    # Let Shopify redeliver later rather than accepting work we can't post
+    if slack_queue.full() or not pending_slots.acquire(blocking=False):
+        processed.discard(fingerprint)
+        logger.warning("⏳ Workers saturated — asking Shopify to retry")
+        return RESP_BUSY
 
-    print(f"📦 Comment matched ST.order #{order_number}", flush=True)
+    if delivery_id:
+        seen_deliveries.add(delivery_id)
 
-    ts = find_thread(order_number)
+    logger.info("📦 Comment matched ST.order #%s", order_number)
 
-    if ts:
-        reply_thread(ts, comment_text, author)
-        return {"status": "posted_in_thread"}, 200
+    EXECUTOR.submit(process_comment, order_number, comment_text, author)
+    return RESP_QUEUED
 
-    # ---- Fallback: post as new message ----
-    slack.chat_postMessage(
-        channel=SLACK_CHANNEL_ID,
-        text=f"💬 *Comment on ST.order #{order_number}*\n{comment_text}\n_(Thread not found)_"
-    )
 
-    print("⚠️ Slack thread not found — posted as new message", flush=True)
-    return {"status": "posted_as_new"}, 200
+@app.route("/slack/events", methods=["POST"])
+def slack_events():
+    if not slack_verifier:
+        abort(404)
+
+    raw_body = request.get_data(cache=False)
+
+    if not slack_verifier.is_valid(
+        raw_body,
+        request.headers.get("X-Slack-Request-Timestamp"),
+        request.headers.get("X-Slack-Signature")
+    ):
+        abort(401, "Invalid Slack signature")
+
+    try:
+        payload = orjson.loads(raw_body) or {}
+    except orjson.JSONDecodeError:
+        payload = {}
+
+    if payload.get("type") == "url_verification":
+        return {"challenge": payload.get("challenge")}
+
+    event = payload.get("event", {})
+    if event.get("type") != "message" or event.get("channel") != SLACK_CHANNEL_ID:
+        return "", 200
+
+    subtype = event.get("subtype")
+
+    # -------- DELETED / EDITED CHANNEL MESSAGE --------
+    # Stop replying into a deleted order message, and re-index an edited one (e.g. a fixed tag)
+    if subtype == "message_deleted":
+        ts = event.get("deleted_ts")
+        order_threads.discard_values({ts})
+        patch_history(ts)
+        return "", 200
+
+    if subtype == "message_changed":
+        event = event.get("message", {})
+        order_threads.discard_values({event.get("ts")})
+        patch_history(event.get("ts"), event)
+    elif subtype not in (None, "bot_message"):
+        return "", 200
+
+    # -------- NEW (OR EDITED) TOP-LEVEL CHANNEL MESSAGE --------
+    # Index order tags as they are posted so find_thread rarely needs conversations.history
+    text = event.get("text", "")
+    if event.get("thread_ts", event.get("ts")) == event.get("ts") and "#" in text:
+        ts = event["ts"]
+        for match in ORDER_REGEX.finditer(text):
+            number = int(match.group(1))
+            # An edited message can be older than the thread already recorded for its order
+            order_threads.set_if(number, ts, lambda current: float(current) < float(ts))
+            logger.info("🧵 Indexed Slack thread for ST.order #%s", number)
+
+        # Let any comment parked for one of these orders go out right away
+        waiting_wakeup.set()
+
+    return "", 200
 
 
 # ---------------- RUN ----------------